@@ -1,30 +1,80 @@
-from typing import List, Dict, Any
+import asyncio
+import logging
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Dict, Any, Literal, Optional, Tuple
 from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException
+import httpx
+import orjson
+from dotenv import load_dotenv
+from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from openai import APIError
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client import multiprocess
 from pydantic import BaseModel
 
 from youtube_utils import (
+    YOUTUBE_API_KEY,
+    clear_caches,
     extract_playlist_id,
     extract_video_id,
+    get_cached_transcript,
     get_playlist_video_ids,
     get_video_transcript,
     get_video_title_description,
 )
-from quiz_generator import generate_questions_from_text
+from quiz_generator import (
+    MAX_TEXT_CHARS,
+    aclient,
+    clear_question_cache,
+    fetch_question_batch,
+    generate_questions_from_text,
+    stream_questions_from_text,
+    submit_question_batch,
+)
+import quiz_store
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="YTQuiz - YouTube Playlist & Video Quiz Generator API")
 
-# CORS (open for frontend on Netlify)
+# CORS for the frontend on Netlify. Set ALLOWED_ORIGINS (comma-separated,
+# e.g. "https://ytquiz.netlify.app") per environment. Unset means no
+# cross-origin access (fail closed). The API uses no cookies or auth, so
+# credentials are never allowed.
+ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "").split(",")
+    if origin.strip()
+]
+if not ALLOWED_ORIGINS:
+    logger.warning("ALLOWED_ORIGINS is not set; cross-origin requests will be rejected")
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # you can restrict to your Netlify domain later
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=86400,  # let browsers cache the preflight for a day
 )
 
+# Prometheus metrics (e.g. question cache hits/misses). With several uvicorn
+# workers, set PROMETHEUS_MULTIPROC_DIR to a directory shared by all of them
+# (emptied before start-up) so /metrics reports totals rather than whichever
+# worker answered the scrape.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+
 
 # ---------- Pydantic models ----------
 
@@ -33,6 +83,9 @@ class GenerateQuizRequest(BaseModel):
     questionsPerVideo: int = 2
     maxVideos: int = 3
     difficulty: str | None = "mixed"  # "easy", "medium", "hard", "mixed"
+    stream: bool = False      # True -> Server-Sent Events, one event per question
+    nocache: bool = False     # True -> always ask OpenAI for fresh questions
+    mode: Literal["sync", "batch"] = "sync"  # "batch": cheaper, poll /quiz-status/{quizId}
 
 
 class PublicQuestion(BaseModel):
@@ -46,6 +99,12 @@ class GenerateQuizResponse(BaseModel):
     questions: List[PublicQuestion]
 
 
+class QuizStatusResponse(BaseModel):
+    quizId: str
+    status: str               # "pending" or "completed"
+    questions: List[PublicQuestion] = []
+
+
 class AnswerItem(BaseModel):
     questionId: int
     selectedIndex: int
@@ -71,38 +130,227 @@ class SubmitQuizResponse(BaseModel):
     results: List[QuestionResult]
 
 
-# In-memory store: quizId -> list of full question dicts (with correct answers)
-QUIZZES: Dict[str, List[Dict[str, Any]]] = {}
+@app.on_event("startup")
+async def open_clients():
+    # Worker threads for blocking calls (transcript fetches via asyncio.to_thread);
+    # enough for every video of a request plus a few concurrent requests
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+
+    # Shared HTTP/2 client for YouTube Data API calls, so every request reuses
+    # the same pooled connections instead of re-handshaking
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await app.state.http.aclose()
+    await aclient.close()
+    await quiz_store.close()
 
 
 # ---------- Basic health check ----------
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "ok"}
 
 @app.get("/")
-def root():
+async def root():
     return {
         "message": "YTQuiz API is running.",
         "health": "/health",
         "generateQuiz": "/generate-quiz",
         "submitQuiz": "/submit-quiz",
+        "quizStatus": "/quiz-status/{quizId}",
     }
 
 
+# ---------- Admin: cache invalidation and metrics ----------
+
+def require_admin_token(x_admin_token: Optional[str]) -> None:
+    """
+    Admin endpoints require the X-Admin-Token header to match ADMIN_TOKEN;
+    they don't exist (404) when ADMIN_TOKEN is not configured.
+    """
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post("/cache/clear")
+async def clear_cache(x_admin_token: str | None = Header(default=None)):
+    """
+    Drop cached transcripts, video metadata, playlist listings and generated
+    questions, e.g. after a video was edited on YouTube.
+
+    Generated questions live in Redis (when configured) and are cleared for
+    every worker. Transcripts, metadata and playlists are cached per process,
+    so only the worker that served this request is cleared; the others expire
+    theirs with the cache TTLs. The response lists which is which.
+    """
+    require_admin_token(x_admin_token)
+
+    clear_caches()
+    local = ["transcripts", "video_metadata", "playlists"]
+    shared = []
+    if await clear_question_cache():
+        shared.append("questions")
+    else:
+        local.append("questions")
+    return {"status": "cleared", "all_workers": shared, "this_worker_only": local}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(x_admin_token: str | None = Header(default=None)):
+    """
+    Prometheus scrape endpoint, behind the same X-Admin-Token as /cache/clear.
+    """
+    require_admin_token(x_admin_token)
+    return Response(generate_latest(METRICS_REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
 # ---------- API: generate quiz (playlist or single video) ----------
 
-@app.post("/generate-quiz", response_model=GenerateQuizResponse)
-def generate_quiz(payload: GenerateQuizRequest):
+async def fetch_video_text(client: httpx.AsyncClient, vid: str) -> Optional[str]:
+    """
+    Get usable text for one video: transcript if available,
+    otherwise title + description. Returns None if neither exists.
+
+    Both lookups start at once, so videos without a transcript wait for
+    max(transcript, metadata) instead of their sum. This costs one YouTube
+    Data API quota unit per video that does have a transcript, so a cached
+    transcript is returned without starting the race. Without
+    YOUTUBE_API_KEY the metadata lookup can only fail, so it isn't raced and
+    only runs (and raises) when there is no transcript.
+    """
+    transcript = get_cached_transcript(vid)
+    if transcript:
+        return transcript
+
+    tasks = [asyncio.create_task(get_video_transcript(vid))]
+    if YOUTUBE_API_KEY:
+        tasks.append(asyncio.create_task(get_video_title_description(client, vid)))
+
+    try:
+        transcript = await tasks[0]
+        if transcript:
+            return transcript
+
+        td = await (tasks[1] if len(tasks) > 1 else get_video_title_description(client, vid))
+    finally:
+        for task in tasks:
+            # Retrieve the error of a lookup that already failed, so it isn't
+            # logged as "Task exception was never retrieved"
+            if task.done() and not task.cancelled():
+                task.exception()
+            # No-op when already done; stops leftover lookups on early return or cancellation
+            task.cancel()
+
+    if not td:
+        # No transcript and no metadata -> skip this video
+        return None
+
+    title, description = td
+    parts: List[str] = []
+    if title:
+        parts.append(f"Video title: {title}")
+    if description:
+        parts.append("Video description:")
+        parts.append(description)
+    return "\n".join(parts).strip() or None
+
+
+def to_internal_question(idx: int, q: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Shape a generated question for storage (keeps correct_index).
+    """
+    return {
+        "id": idx,
+        "question": q["question"],
+        "options": q["options"],
+        "correct_index": q["correct_index"],
+        "explanation": q.get("explanation", ""),
+    }
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: ".encode() + orjson.dumps(data) + b"\n\n"
+
+
+async def stream_quiz_events(
+    video_texts: List[Tuple[str, str]],
+    questions_per_video: int,
+    difficulty: str | None,
+    use_cache: bool,
+) -> AsyncIterator[bytes]:
+    """
+    SSE body for a streamed quiz:
+    - "quiz" with the quizId first,
+    - one "question" (PublicQuestion) per question as the model finishes it,
+    - "done" once the quiz is stored and can be submitted (or "error").
+    """
+    quiz_id = str(uuid4())
+    yield sse_event("quiz", {"quizId": quiz_id})
+
+    all_questions: List[Dict[str, Any]] = []
+    try:
+        async for q in stream_questions_from_text(
+            video_texts,
+            questions_per_video=questions_per_video,
+            difficulty=difficulty,
+            use_cache=use_cache,
+        ):
+            question = to_internal_question(len(all_questions), q)
+            all_questions.append(question)
+            public = PublicQuestion(
+                id=question["id"],
+                question=question["question"],
+                options=question["options"],
+            )
+            yield sse_event("question", public.model_dump())
+    except (APIError, RuntimeError):
+        # Headers (200) are already sent, so report the failure in-stream
+        yield sse_event(
+            "error",
+            {"detail": "The AI stopped responding while generating this quiz. Please try again."},
+        )
+        return
+
+    if not all_questions:
+        yield sse_event(
+            "error",
+            {"detail": "The AI could not generate questions from this content. Try a different link."},
+        )
+        return
+
+    await quiz_store.save_quiz(quiz_id, all_questions)
+    yield sse_event("done", {"quizId": quiz_id, "total": len(all_questions)})
+
+
+@app.post(
+    "/generate-quiz",
+    response_model=GenerateQuizResponse,
+    responses={202: {"model": QuizStatusResponse, "description": "Batch quiz queued"}},
+)
+async def generate_quiz(payload: GenerateQuizRequest):
     """
     Generate quiz questions from a YouTube playlist OR a single video.
 
     - Detect whether the URL is a playlist or a single video.
     - Build a list of video_ids accordingly.
-    - Collect text (transcript OR title+description) from those videos.
-    - Combine into one big text.
-    - Call OpenAI ONCE to generate all questions.
+    - Collect text (transcript OR title+description) from those videos,
+      fetching all videos concurrently.
+    - Call OpenAI with every video as a labeled block of one prompt
+      (grouped into several concurrent calls for long playlists).
+    - With `stream=True`, return Server-Sent Events instead, one per question.
+    - With `mode="batch"`, queue the work on OpenAI's Batch API and return
+      a pending quizId to poll via /quiz-status/{quizId}.
     """
 
     # Clamp user inputs to avoid huge quiz requests
@@ -121,7 +369,7 @@ def generate_quiz(payload: GenerateQuizRequest):
 
     if playlist_id:
         # Treat as playlist
-        video_ids = get_playlist_video_ids(playlist_id, max_videos=max_videos)
+        video_ids = await get_playlist_video_ids(app.state.http, playlist_id, max_videos=max_videos)
         if not video_ids:
             raise HTTPException(status_code=404, detail="No videos found in this playlist.")
     else:
@@ -134,33 +382,11 @@ def generate_quiz(payload: GenerateQuizRequest):
             )
         video_ids = [video_id]
 
-    # 2) Collect text for each video (transcript OR title+description)
-    video_texts: List[str] = []
-
-    for vid in video_ids:
-        transcript = get_video_transcript(vid)
-
-        if transcript:
-            text = transcript
-        else:
-            td = get_video_title_description(vid)
-            if not td:
-                # No transcript and no metadata -> skip this video
-                continue
-
-            title, description = td
-            parts: List[str] = []
-            if title:
-                parts.append(f"Video title: {title}")
-            if description:
-                parts.append("Video description:")
-                parts.append(description)
-            text = "\n".join(parts).strip()
-
-            if not text:
-                continue
-
-        video_texts.append(text)
+    # 2) Collect text for each video (transcript OR title+description), in parallel
+    results = await asyncio.gather(*[fetch_video_text(app.state.http, vid) for vid in video_ids])
+    video_texts: List[Tuple[str, str]] = [
+        (vid, text) for vid, text in zip(video_ids, results) if text
+    ]
 
     if not video_texts:
         raise HTTPException(
@@ -171,21 +397,54 @@ def generate_quiz(payload: GenerateQuizRequest):
             ),
         )
 
-    # 3) Combine all text into one big block for a single AI call
-    combined_text = "\n\n".join(video_texts)
-
-    # Total number of questions = questions_per_video * number of usable videos
-    total_questions = questions_per_video * len(video_texts)
+    # Split the text budget evenly so every video contributes to the prompt
+    budget_per_video = MAX_TEXT_CHARS // len(video_texts)
+    video_texts = [(vid, text[:budget_per_video]) for vid, text in video_texts]
+
+    # Global safety cap so it doesn't get huge (adjust if you want larger quizzes):
+    # at most 30 questions total, spread evenly so every video contributes
+    per_video = max(1, min(questions_per_video, 30 // len(video_texts)))
+
+    # 3) Call OpenAI with all videos as labeled blocks (one call per group of videos)
+    if payload.mode == "batch":
+        # Queue on OpenAI's Batch API; the batch id doubles as the quizId
+        try:
+            batch_id = await submit_question_batch(
+                video_texts,
+                questions_per_video=per_video,
+                difficulty=payload.difficulty,
+            )
+        except APIError:
+            raise HTTPException(
+                status_code=502,
+                detail="The AI service could not queue this quiz. Please try again.",
+            )
+        await quiz_store.save_batch(batch_id)
+        return JSONResponse(
+            status_code=202,
+            content=QuizStatusResponse(quizId=batch_id, status="pending").model_dump(),
+        )
 
-    # Global safety cap so it doesn't get huge (adjust if you want larger quizzes)
-    total_questions = max(1, min(total_questions, 30))  # e.g. up to 30 questions total
+    if payload.stream:
+        # Questions are sent as soon as they are generated; quiz is stored at the end
+        return StreamingResponse(
+            stream_quiz_events(video_texts, per_video, payload.difficulty, not payload.nocache),
+            media_type="text/event-stream",
+        )
 
-    # 4) Call OpenAI ONCE to generate all questions
-    questions_raw = generate_questions_from_text(
-        combined_text,
-        num_questions=total_questions,
-        difficulty=payload.difficulty,
-    )
+    try:
+        questions_raw = await generate_questions_from_text(
+            video_texts,
+            questions_per_video=per_video,
+            difficulty=payload.difficulty,
+            use_cache=not payload.nocache,
+        )
+    except (APIError, RuntimeError):
+        # Invalid JSON, or OpenAI timed out / failed after retries
+        raise HTTPException(
+            status_code=502,
+            detail="The AI returned an invalid response. Please try again.",
+        )
 
     if not questions_raw:
         raise HTTPException(
@@ -193,22 +452,14 @@ def generate_quiz(payload: GenerateQuizRequest):
             detail="The AI could not generate questions from this content. Try a different link.",
         )
 
-    # 5) Prepare internal question data
-    all_questions: List[Dict[str, Any]] = []
-    for idx, q in enumerate(questions_raw):
-        all_questions.append(
-            {
-                "id": idx,
-                "question": q["question"],
-                "options": q["options"],
-                "correct_index": q["correct_index"],
-                "explanation": q.get("explanation", ""),
-            }
-        )
+    # 4) Prepare internal question data (ids are contiguous across all videos)
+    all_questions: List[Dict[str, Any]] = [
+        to_internal_question(idx, q) for idx, q in enumerate(questions_raw)
+    ]
 
-    # 6) Store quiz in memory and return public version (no correct_index)
+    # 5) Store quiz (Redis, or memory fallback) and return public version (no correct_index)
     quiz_id = str(uuid4())
-    QUIZZES[quiz_id] = all_questions
+    await quiz_store.save_quiz(quiz_id, all_questions)
 
     public_questions = [
         PublicQuestion(
@@ -222,29 +473,75 @@ def generate_quiz(payload: GenerateQuizRequest):
     return GenerateQuizResponse(quizId=quiz_id, questions=public_questions)
 
 
+# ---------- API: batch quiz status ----------
+
+@app.get("/quiz-status/{quiz_id}", response_model=QuizStatusResponse)
+async def quiz_status(quiz_id: str):
+    """
+    Poll a quiz generated with mode="batch". Once OpenAI's batch job has
+    finished, the questions are stored like any other quiz, so /submit-quiz
+    works with the same quizId.
+    """
+    quiz_questions = await quiz_store.load_quiz(quiz_id)
+
+    if quiz_questions is None:
+        # Only poll OpenAI for batch ids we issued (not arbitrary input)
+        if not await quiz_store.is_known_batch(quiz_id):
+            raise HTTPException(status_code=404, detail="Quiz not found")
+
+        try:
+            questions_raw = await fetch_question_batch(quiz_id)
+        except (APIError, RuntimeError):
+            raise HTTPException(
+                status_code=502,
+                detail="The AI could not finish generating this quiz. Please try again.",
+            )
+
+        if questions_raw is None:
+            return QuizStatusResponse(quizId=quiz_id, status="pending")
+        if not questions_raw:
+            raise HTTPException(
+                status_code=500,
+                detail="The AI could not generate questions from this content. Try a different link.",
+            )
+
+        quiz_questions = [to_internal_question(idx, q) for idx, q in enumerate(questions_raw)]
+        await quiz_store.save_quiz(quiz_id, quiz_questions)
+
+    public_questions = [
+        PublicQuestion(
+            id=q["id"],
+            question=q["question"],
+            options=q["options"],
+        )
+        for q in quiz_questions
+    ]
+
+    return QuizStatusResponse(quizId=quiz_id, status="completed", questions=public_questions)
+
+
 # ---------- API: submit quiz ----------
 
 @app.post("/submit-quiz", response_model=SubmitQuizResponse)
-def submit_quiz(payload: SubmitQuizRequest):
-    quiz_questions = QUIZZES.get(payload.quizId)
+async def submit_quiz(payload: SubmitQuizRequest):
+    quiz_questions = await quiz_store.load_quiz(payload.quizId)
     if quiz_questions is None:
         raise HTTPException(status_code=404, detail="Quiz not found")
 
-    # Map questionId -> question
-    question_map = {q["id"]: q for q in quiz_questions}
-
+    # Question ids are 0..N-1 (assigned in generate_quiz), so the stored
+    # list can be indexed directly instead of building an id -> question map
+    total = len(quiz_questions)
     correct_count = 0
     results: List[QuestionResult] = []
 
     for ans in payload.answers:
-        q = question_map.get(ans.questionId)
-        if not q:
+        if not 0 <= ans.questionId < total:
             # Ignore invalid question IDs
             continue
+        q = quiz_questions[ans.questionId]
 
         is_correct = ans.selectedIndex == q["correct_index"]
-        if is_correct:
-            correct_count += 1
+        correct_count += is_correct
 
         results.append(
             QuestionResult(
@@ -252,11 +549,10 @@ def submit_quiz(payload: SubmitQuizRequest):
                 correctIndex=q["correct_index"],
                 selectedIndex=ans.selectedIndex,
                 isCorrect=is_correct,
-                explanation=q.get("explanation", ""),
+                explanation=q["explanation"],
             )
         )
 
-    total = len(question_map)
     percentage = (correct_count / total * 100) if total else 0.0
 
     return SubmitQuizResponse(
@@ -1,9 +1,17 @@
+import asyncio
 import os
-import json
-from typing import List, Dict, Any, Optional
+import re
+from hashlib import blake2b
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
+import httpx
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+from prometheus_client import Counter
+from pydantic import BaseModel, ConfigDict, ValidationError, conint, conlist
+
+import quiz_store
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -11,28 +19,464 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is not set in .env")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-
-def generate_questions_from_text(
-    text: str,
-    num_questions: int = 5,
+# One client for the whole process, with a connection pool large enough for
+# many concurrent quizzes (httpx's defaults would queue requests under load)
+aclient = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=2,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+
+# Non-streamed completions get a single attempt: retrying after a read
+# timeout would keep the user waiting several minutes for one quiz. Shares
+# aclient's connection pool.
+_single_attempt_client = aclient.with_options(max_retries=0)
+
+# Several videos share one prompt (instructions are paid for once per call),
+# but accuracy drops when too many are packed together.
+MAX_VIDEOS_PER_CALL = 5
+
+# Total study-material budget per quiz; callers split it across videos
+MAX_TEXT_CHARS = 8000
+
+# Defensive per-video cap in case a caller passes untruncated text
+MAX_CHARS_PER_VIDEO = 8000
+
+# Generated questions are cached in quiz_store (Redis when configured, so
+# all workers share them) keyed by hash of (video text, count, difficulty),
+# so popular videos skip the OpenAI call entirely.
+
+QUESTION_CACHE_HITS = Counter(
+    "ytquiz_question_cache_hits_total",
+    "Videos whose quiz questions were served from the question cache",
+)
+QUESTION_CACHE_MISSES = Counter(
+    "ytquiz_question_cache_misses_total",
+    "Videos whose quiz questions had to be generated by OpenAI",
+)
+
+
+async def generate_questions_from_text(
+    videos: List[Tuple[str, str]],
+    questions_per_video: int = 2,
     difficulty: Optional[str] = "mixed",
+    use_cache: bool = True,
 ) -> List[Dict[str, Any]]:
     """
-    Generate multiple-choice questions from text using OpenAI (gpt-4o-mini).
+    Generate multiple-choice questions for several videos using OpenAI (gpt-4o-mini).
+
+    `videos` is a list of (video_id, text) pairs. Videos whose questions are
+    cached (same text, count and difficulty) skip OpenAI unless use_cache is
+    False. The rest are sent in groups of up to MAX_VIDEOS_PER_CALL as labeled
+    blocks in a single prompt, and the groups run concurrently. Returns the
+    questions of all videos in input order, each tagged with its "video_id".
+    """
+    target_questions = max(1, int(questions_per_video))
+
+    per_video: List[Optional[List[Dict[str, Any]]]] = [None] * len(videos)
+    if use_cache:
+        per_video = list(
+            await asyncio.gather(
+                *[
+                    _cached_questions(video_id, text, target_questions, difficulty)
+                    for video_id, text in videos
+                ]
+            )
+        )
+    pending = [i for i, questions in enumerate(per_video) if questions is None]
+
+    batches = [
+        pending[i:i + MAX_VIDEOS_PER_CALL]
+        for i in range(0, len(pending), MAX_VIDEOS_PER_CALL)
+    ]
+    results = await asyncio.gather(
+        *[
+            _generate_for_batch([videos[i] for i in batch], target_questions, difficulty)
+            for batch in batches
+        ]
+    )
+    for batch, batch_questions in zip(batches, results):
+        for i, questions in zip(batch, batch_questions):
+            per_video[i] = questions
+
+    return [q for questions in per_video for q in questions or []]
+
+
+async def _generate_for_batch(
+    batch: List[Tuple[str, str]],
+    questions_per_video: int,
+    difficulty: Optional[str],
+) -> List[List[Dict[str, Any]]]:
+    """
+    Generate questions for one group of videos with a single OpenAI call.
+    Returns one question list per video, in batch order.
 
     Strategy:
-    - Oversample (ask for more questions than needed),
+    - Ask for one spare question per video (in case one is malformed),
     - Enforce JSON output (response_format),
     - Filter invalid entries,
-    - Then return up to num_questions valid questions.
+    - Then keep up to questions_per_video valid questions per video.
+    """
+
+    # Target number of questions per video requested by caller
+    target_questions = max(1, int(questions_per_video))
+
+    messages = _build_messages(batch, target_questions, difficulty)
+
+    # Use gpt-4o-mini (cheap) but enforce JSON output
+    response = await _single_attempt_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=0.2,
+        response_format={"type": "json_object"},
+    )
+
+    content = response.choices[0].message.content
+    per_video = _parse_per_video(content, [video_id for video_id, _ in batch], target_questions)
+
+    for (_, text), questions in zip(batch, per_video):
+        await _cache_questions(text, target_questions, difficulty, questions)
+    return per_video
+
+
+async def submit_question_batch(
+    videos: List[Tuple[str, str]],
+    questions_per_video: int = 2,
+    difficulty: Optional[str] = "mixed",
+) -> str:
+    """
+    Queue question generation on OpenAI's Batch API (about half the price,
+    results within 24h) and return the batch id.
+
+    Each group of up to MAX_VIDEOS_PER_CALL videos becomes one request line.
+    The video ids of each group are kept in the batch metadata, so
+    fetch_question_batch can map the results back.
+    """
+    target_questions = max(1, int(questions_per_video))
+    metadata = {"questions_per_video": str(target_questions)}
+    lines: List[bytes] = []
+
+    for n, i in enumerate(range(0, len(videos), MAX_VIDEOS_PER_CALL)):
+        batch = videos[i:i + MAX_VIDEOS_PER_CALL]
+        custom_id = f"group-{n}"
+        metadata[custom_id] = ",".join(video_id for video_id, _ in batch)
+        lines.append(
+            orjson.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": "gpt-4o-mini",
+                        "messages": _build_messages(batch, target_questions, difficulty),
+                        "temperature": 0.2,
+                        "response_format": {"type": "json_object"},
+                    },
+                }
+            )
+        )
+
+    input_file = await aclient.files.create(
+        file=("questions.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    job = await aclient.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata=metadata,
+    )
+    return job.id
+
+
+async def fetch_question_batch(batch_id: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Collect the questions of a batch queued with submit_question_batch.
+
+    Returns None while the batch is still running, and raises RuntimeError
+    if it failed, expired or was cancelled.
+    """
+    job = await aclient.batches.retrieve(batch_id)
+    if job.status in ("failed", "expired", "cancelling", "cancelled"):
+        raise RuntimeError(f"OpenAI batch {batch_id} ended with status {job.status}")
+    if job.status != "completed":
+        return None
+    if not job.output_file_id:
+        return []
+
+    output = await aclient.files.content(job.output_file_id)
+    content_by_group: Dict[str, str] = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") == 200:
+            content_by_group[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+    metadata = job.metadata or {}
+    target_questions = int(metadata.get("questions_per_video", 1))
+    groups = sorted(
+        (key for key in metadata if key.startswith("group-")),
+        key=lambda key: int(key.split("-", 1)[1]),
+    )
+
+    questions: List[Dict[str, Any]] = []
+    for group in groups:
+        if group not in content_by_group:
+            continue
+        per_video = _parse_per_video(
+            content_by_group[group], metadata[group].split(","), target_questions
+        )
+        questions.extend(q for video_questions in per_video for q in video_questions)
+    return questions
+
+
+def _parse_per_video(
+    content: str,
+    video_ids: List[str],
+    target_questions: int,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Parse a {"per_video": [...]} completion into one list of valid questions
+    (at most target_questions) per video, in block order.
+    """
+
+    # JSON mode guarantees valid JSON, so a parse failure is a real error
+    # (e.g. truncated output) rather than "no questions"
+    try:
+        data = orjson.loads(content)
+    except orjson.JSONDecodeError as exc:
+        raise RuntimeError("OpenAI returned invalid JSON despite JSON mode") from exc
+
+    # Map block label ("V1", "V2", ...) -> raw questions for that block
+    raw_by_label: Dict[str, List[Any]] = {}
+    for entry in data.get("per_video", []):
+        if isinstance(entry, dict) and isinstance(entry.get("questions"), list):
+            raw_by_label[str(entry.get("id"))] = entry["questions"]
+
+    return [
+        _clean_questions(raw_by_label.get(f"V{i}", []), video_id)[:target_questions]
+        for i, video_id in enumerate(video_ids, start=1)
+    ]
+
+
+async def stream_questions_from_text(
+    videos: List[Tuple[str, str]],
+    questions_per_video: int = 2,
+    difficulty: Optional[str] = "mixed",
+    use_cache: bool = True,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of generate_questions_from_text: yields each question
+    as soon as the model has finished writing it, instead of waiting for the
+    whole completion. Cached videos come first, then groups of uncached
+    videos are streamed one after another.
+    """
+    target_questions = max(1, int(questions_per_video))
+
+    pending: List[Tuple[str, str]] = []
+    for video_id, text in videos:
+        cached = (
+            await _cached_questions(video_id, text, target_questions, difficulty)
+            if use_cache
+            else None
+        )
+        if cached is None:
+            pending.append((video_id, text))
+            continue
+        for q in cached:
+            yield q
+
+    for i in range(0, len(pending), MAX_VIDEOS_PER_CALL):
+        batch = pending[i:i + MAX_VIDEOS_PER_CALL]
+        async for q in _stream_batch(batch, target_questions, difficulty):
+            yield q
+
+
+async def _stream_batch(
+    batch: List[Tuple[str, str]],
+    questions_per_video: int,
+    difficulty: Optional[str],
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream one OpenAI call for a group of videos, yielding valid questions
+    (up to questions_per_video per video) as they complete.
+    """
+    target_questions = max(1, int(questions_per_video))
+    video_ids = {f"V{i}": video_id for i, (video_id, _) in enumerate(batch, start=1)}
+    collected: Dict[str, List[Dict[str, Any]]] = {label: [] for label in video_ids}
+    parser = _QuestionStreamParser()
+
+    messages = _build_messages(batch, target_questions, difficulty)
+
+    # Deltas are buffered in a queue, so the pooled OpenAI connection is held
+    # only while the model generates, never while a slow client reads the stream
+    deltas: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
+    async def pump() -> None:
+        stream = await aclient.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.2,
+            response_format={"type": "json_object"},
+            stream=True,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas.put_nowait(chunk.choices[0].delta.content)
+
+    producer = asyncio.create_task(pump())
+    producer.add_done_callback(lambda _: deltas.put_nowait(None))
+    try:
+        while (delta := await deltas.get()) is not None:
+            for label, raw in parser.feed(delta):
+                if label not in video_ids or len(collected[label]) >= target_questions:
+                    continue
+                for q in _clean_questions([raw], video_ids[label]):
+                    collected[label].append(q)
+                    yield q
+
+        # Re-raise OpenAI errors from the stream (e.g. connection dropped mid-way)
+        producer.result()
+    finally:
+        producer.cancel()
+
+    for i, (_, text) in enumerate(batch, start=1):
+        await _cache_questions(text, target_questions, difficulty, collected[f"V{i}"])
+
+
+async def clear_question_cache() -> bool:
+    """
+    Drop all cached generated questions. Returns True if every worker's view
+    was cleared (shared Redis cache), False if only this process's was.
+    """
+    return await quiz_store.clear_questions()
+
+
+def _question_cache_key(text: str, num_questions: int, difficulty: Optional[str]) -> str:
+    return blake2b(
+        text.encode()
+        + num_questions.to_bytes(2, "big")
+        + (difficulty or "mixed").lower().encode()
+    ).hexdigest()
+
+
+async def _cached_questions(
+    video_id: str,
+    text: str,
+    num_questions: int,
+    difficulty: Optional[str],
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Return cached questions for this text (tagged with video_id), or None.
+    """
+    cached = await quiz_store.load_questions(_question_cache_key(text, num_questions, difficulty))
+    if cached is None:
+        QUESTION_CACHE_MISSES.inc()
+        return None
+
+    QUESTION_CACHE_HITS.inc()
+    return [{**q, "video_id": video_id} for q in cached]
+
+
+async def _cache_questions(
+    text: str,
+    num_questions: int,
+    difficulty: Optional[str],
+    questions: List[Dict[str, Any]],
+) -> None:
+    # Only cache complete results, so a poor generation doesn't stick for 30 days
+    if len(questions) == num_questions:
+        await quiz_store.save_questions(_question_cache_key(text, num_questions, difficulty), questions)
+
+
+class _QuestionStreamParser:
+    """
+    Incremental scanner for the {"per_video": [{"id": ..., "questions": [...]}]}
+    output. Tracks string/nesting state across chunks and returns each
+    question object once its closing brace has arrived.
     """
 
-    # Truncate very long text to keep prompt manageable
-    max_chars = 8000
-    if len(text) > max_chars:
-        text = text[:max_chars]
+    # Nesting when a question object opens: root {, per_video [, entry {, questions [
+    _QUESTION_DEPTH = 4
+    _ENTRY_ID_RE = re.compile(r'"id"\s*:\s*"([^"]*)"')
+
+    def __init__(self) -> None:
+        self._text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._entry_start = 0
+        self._entry_count = 0
+        self._question_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+        Add streamed text; return (block label, parsed question) for every
+        question object completed by this chunk.
+        """
+        self._text += chunk
+        completed: List[Tuple[str, Any]] = []
+
+        while self._pos < len(self._text):
+            ch = self._text[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and len(self._stack) == 2:
+                    # A new per_video entry
+                    self._entry_start = self._pos
+                    self._entry_count += 1
+                elif ch == "{" and len(self._stack) == self._QUESTION_DEPTH:
+                    self._question_start = self._pos
+                self._stack.append(ch)
+            elif ch in "}]" and self._stack:
+                self._stack.pop()
+                if (
+                    ch == "}"
+                    and len(self._stack) == self._QUESTION_DEPTH
+                    and self._question_start is not None
+                ):
+                    raw = self._text[self._question_start:self._pos + 1]
+                    self._question_start = None
+                    try:
+                        completed.append((self._entry_label(), orjson.loads(raw)))
+                    except orjson.JSONDecodeError:
+                        pass
+
+            self._pos += 1
+
+        return completed
+
+    def _entry_label(self) -> str:
+        # The model normally writes "id" before "questions"; fall back to the
+        # entry's position if it hasn't
+        match = self._ENTRY_ID_RE.search(self._text, self._entry_start, self._pos)
+        return match.group(1) if match else f"V{self._entry_count}"
+
+
+def _build_messages(
+    batch: List[Tuple[str, str]],
+    target_questions: int,
+    difficulty: Optional[str],
+) -> List[Dict[str, str]]:
+    """
+    Build the chat messages asking for questions on each labeled video block.
+    """
 
     # Normalize difficulty
     difficulty = (difficulty or "mixed").lower()
@@ -64,26 +508,28 @@ def generate_questions_from_text(
         "for students, based ONLY on the provided study material."
     )
 
-    # Target number of questions requested by caller
-    target_questions = max(1, int(num_questions))
+    # Ask for one spare question per block; with JSON mode and an explicit
+    # count, the model rarely misses, so heavier oversampling only costs tokens.
+    overshoot = target_questions + 1
 
-    # Oversample: ask the model for more questions than we need,
-    # then we will select the first target_questions valid ones.
-    overshoot = max(target_questions + 3, target_questions * 2)
-    overshoot = min(overshoot, 30)  # absolute safety cap
+    blocks = "\n\n".join(
+        f"<<V{i}>>\n{text[:MAX_CHARS_PER_VIDEO]}\n<</V{i}>>"
+        for i, (_, text) in enumerate(batch, start=1)
+    )
 
     user_prompt = f"""
-You are given study material (transcript or text) from one or more video lessons.
+You are given study material (transcript or text) from {len(batch)} video lesson(s).
+Each video is a separate labeled block: <<V1>> ... <</V1>>, <<V2>> ... <</V2>>, and so on.
 
 Your task:
-- Write {overshoot} HIGH-QUALITY multiple-choice questions that help students
-  truly understand and think about the concepts in the text.
+- For EACH labeled block, write {overshoot} HIGH-QUALITY multiple-choice questions
+  that help students truly understand and think about the concepts in that block.
 
 VERY IMPORTANT CONSTRAINTS:
 
 1) CONTENT-BASED, NOT META
    - Questions MUST be about the actual subject matter (concepts, definitions, reasoning,
-     examples, procedures) found in the text.
+     examples, procedures) found in the study material.
    - DO NOT ask meta questions like:
      - "What is taught in this video?"
      - "What will you learn in this playlist?"
@@ -101,7 +547,7 @@ VERY IMPORTANT CONSTRAINTS:
    - Recall questions (basic definitions) are allowed, but do NOT make them trivial or vague.
 
 3) GROUNDED IN THE TEXT
-   - Every question and correct answer MUST be answerable strictly from the given text.
+   - Every question and correct answer MUST be answerable strictly from the text of its OWN block.
    - Do NOT invent facts that are not implied or stated in the text.
    - Do NOT use outside knowledge beyond what a careful reader could infer.
 
@@ -121,71 +567,66 @@ VERY IMPORTANT CONSTRAINTS:
    - {diff_instruction}
 
 7) EXACT COUNT
-   - You MUST return EXACTLY {overshoot} questions in the JSON.
-   - If the study material seems short or repetitive, you must still create {overshoot}
+   - You MUST return EXACTLY {overshoot} questions for EACH block in the JSON.
+   - If a block seems short or repetitive, you must still create {overshoot}
      distinct, non-duplicate questions by focusing on nuances, comparisons,
      typical misconceptions, or implications of the content.
 
 Study material (use ONLY this):
 
-\"\"\"{text}\"\"\"
+{blocks}
 
-Return JSON ONLY in this exact structure (no backticks, no extra text):
+Return JSON ONLY in this exact structure (no backticks, no extra text),
+with one "per_video" entry per block, using the block label as "id":
 
 {{
-  "questions": [
+  "per_video": [
     {{
-      "question": "string",
-      "options": ["option A", "option B", "option C", "option D"],
-      "correct_index": 0,
-      "explanation": "string"
+      "id": "V1",
+      "questions": [
+        {{
+          "question": "string",
+          "options": ["option A", "option B", "option C", "option D"],
+          "correct_index": 0,
+          "explanation": "string"
+        }}
+      ]
     }}
   ]
 }}
 """
 
-    # Use gpt-4o-mini (cheap) but enforce JSON output
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,
-        response_format={"type": "json_object"},
-    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
 
-    content = response.choices[0].message.content
 
-    # Parse JSON
-    try:
-        data = json.loads(content)
-    except json.JSONDecodeError:
-        return []
+class RawQuestion(BaseModel):
+    """
+    One question as returned by the model. Strict, so nothing is coerced
+    (e.g. "1" is not accepted as a correct_index).
+    """
+    model_config = ConfigDict(strict=True)
+
+    question: str
+    options: conlist(str, min_length=4, max_length=4)
+    correct_index: conint(ge=0, lt=4)
+    explanation: Optional[str] = ""
+
 
-    questions = data.get("questions", [])
+def _clean_questions(questions: List[Any], video_id: str) -> List[Dict[str, Any]]:
+    """
+    Keep only well-formed questions (4 options, valid correct_index).
+    """
     cleaned: List[Dict[str, Any]] = []
 
     for q in questions:
-        if (
-            isinstance(q.get("question"), str)
-            and isinstance(q.get("options"), list)
-            and len(q["options"]) == 4
-            and isinstance(q.get("correct_index"), int)
-            and 0 <= q["correct_index"] < 4
-        ):
-            cleaned.append(
-                {
-                    "question": q["question"],
-                    "options": q["options"],
-                    "correct_index": q["correct_index"],
-                    "explanation": q.get("explanation", ""),
-                }
-            )
-
-    # If we got at least target_questions valid ones, just return the first target_questions
-    if len(cleaned) >= target_questions:
-        return cleaned[:target_questions]
+        try:
+            question = RawQuestion.model_validate(q).model_dump()
+        except ValidationError:
+            continue
+        question["video_id"] = video_id
+        cleaned.append(question)
 
-    # Otherwise return whatever we got (still could be fewer if the content is very poor)
     return cleaned
@@ -0,0 +1,159 @@
+import logging
+import os
+from typing import List, Dict, Any, Optional
+
+import orjson
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+load_dotenv()
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Quizzes expire after an hour (nobody submits a quiz the next day)
+QUIZ_TTL_SECONDS = 3600
+
+# Issued OpenAI batch ids are remembered past the 24h completion window
+BATCH_TTL_SECONDS = 48 * 3600
+
+# Generated questions are reused for a month (see quiz_generator)
+QUESTION_TTL_SECONDS = 30 * 86400
+
+logger = logging.getLogger(__name__)
+
+# Redis lets every worker/pod see every quiz, so /submit-quiz works no matter
+# which process answered /generate-quiz. Short timeouts make a dead Redis
+# fall back to process memory instead of hanging the request.
+_redis: Optional[Redis] = (
+    Redis.from_url(REDIS_URL, socket_connect_timeout=1, socket_timeout=1)
+    if REDIS_URL
+    else None
+)
+
+# Fallback when Redis is not configured or unreachable. Only correct with a
+# single worker, but bounded and expiring instead of growing forever.
+_local_quizzes: TTLCache = TTLCache(maxsize=10_000, ttl=QUIZ_TTL_SECONDS)
+_local_batches: TTLCache = TTLCache(maxsize=10_000, ttl=BATCH_TTL_SECONDS)
+_local_questions: TTLCache = TTLCache(maxsize=2048, ttl=QUESTION_TTL_SECONDS)
+
+if _redis is None:
+    logger.warning("REDIS_URL is not set; storing quizzes in process memory")
+
+
+def _key(quiz_id: str) -> str:
+    return f"quiz:{quiz_id}"
+
+
+async def save_quiz(quiz_id: str, questions: List[Dict[str, Any]]) -> None:
+    """
+    Store the full question list (with correct answers) for a quiz.
+    """
+    if _redis is not None:
+        try:
+            await _redis.set(_key(quiz_id), orjson.dumps(questions), ex=QUIZ_TTL_SECONDS)
+            return
+        except RedisError:
+            logger.warning("Redis unavailable; storing quiz %s in process memory", quiz_id)
+
+    _local_quizzes[quiz_id] = questions
+
+
+async def load_quiz(quiz_id: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Return the stored question list for a quiz, or None if unknown/expired.
+    """
+    if _redis is not None:
+        try:
+            blob = await _redis.get(_key(quiz_id))
+            if blob is not None:
+                return orjson.loads(blob)
+        except RedisError:
+            logger.warning("Redis unavailable; looking up quiz %s in process memory", quiz_id)
+
+    return _local_quizzes.get(quiz_id)
+
+
+async def save_batch(batch_id: str) -> None:
+    """
+    Remember an OpenAI batch id issued by this service, so /quiz-status only
+    polls OpenAI for batches we created.
+    """
+    if _redis is not None:
+        try:
+            await _redis.set(f"batch:{batch_id}", b"1", ex=BATCH_TTL_SECONDS)
+            return
+        except RedisError:
+            logger.warning("Redis unavailable; storing batch %s in process memory", batch_id)
+
+    _local_batches[batch_id] = True
+
+
+async def is_known_batch(batch_id: str) -> bool:
+    """
+    True if batch_id was issued by this service and hasn't expired.
+    """
+    if _redis is not None:
+        try:
+            if await _redis.exists(f"batch:{batch_id}"):
+                return True
+        except RedisError:
+            logger.warning("Redis unavailable; looking up batch %s in process memory", batch_id)
+
+    return batch_id in _local_batches
+
+
+async def save_questions(key: str, questions: List[Dict[str, Any]]) -> None:
+    """
+    Cache generated questions under a content hash (see quiz_generator).
+    """
+    if _redis is not None:
+        try:
+            await _redis.set(f"questions:{key}", orjson.dumps(questions), ex=QUESTION_TTL_SECONDS)
+            return
+        except RedisError:
+            logger.warning("Redis unavailable; caching questions in process memory")
+
+    _local_questions[key] = questions
+
+
+async def load_questions(key: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Return cached questions for a content hash, or None.
+    """
+    if _redis is not None:
+        try:
+            blob = await _redis.get(f"questions:{key}")
+            if blob is not None:
+                return orjson.loads(blob)
+        except RedisError:
+            logger.warning("Redis unavailable; looking up cached questions in process memory")
+
+    return _local_questions.get(key)
+
+
+async def clear_questions() -> bool:
+    """
+    Drop all cached generated questions. Returns True if the shared Redis
+    copy was cleared, False if only this process's memory was.
+    """
+    _local_questions.clear()
+    if _redis is None:
+        return False
+
+    try:
+        keys = [key async for key in _redis.scan_iter(match="questions:*", count=1000)]
+        if keys:
+            await _redis.delete(*keys)
+        return True
+    except RedisError:
+        logger.warning("Redis unavailable; only clearing questions cached in process memory")
+        return False
+
+
+async def close() -> None:
+    """
+    Close the Redis connection pool (called on app shutdown).
+    """
+    if _redis is not None:
+        await _redis.aclose()
@@ -0,0 +1,223 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import httpx
+import openai
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import main  # noqa: E402
+
+
+def test_stream_quiz_events_reports_mid_stream_openai_failure(monkeypatch):
+    async def failing_stream(videos, questions_per_video, difficulty, use_cache):
+        yield {
+            "question": "q1",
+            "options": ["a", "b", "c", "d"],
+            "correct_index": 0,
+            "explanation": "",
+        }
+        raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+
+    saved = []
+
+    async def fake_save(quiz_id, questions):
+        saved.append(quiz_id)
+
+    monkeypatch.setattr(main, "stream_questions_from_text", failing_stream)
+    monkeypatch.setattr(main.quiz_store, "save_quiz", fake_save)
+
+    async def collect():
+        return [
+            event async for event in main.stream_quiz_events([("vid", "text")], 1, "mixed", True)
+        ]
+
+    events = [event.split(b"\n", 1)[0] for event in asyncio.run(collect())]
+
+    assert events == [b"event: quiz", b"event: question", b"event: error"]
+    assert saved == []
+
+
+def test_quiz_status_does_not_poll_openai_for_unknown_ids(monkeypatch):
+    polled = []
+
+    async def fake_fetch(batch_id):
+        polled.append(batch_id)
+        return None
+
+    monkeypatch.setattr(main, "fetch_question_batch", fake_fetch)
+
+    response = TestClient(main.app).get("/quiz-status/batch_not_issued_here")
+
+    assert response.status_code == 404
+    assert polled == []
+
+
+def test_generate_quiz_maps_openai_timeout_to_502(monkeypatch):
+    async def fake_transcript(video_id, languages=("en",)):
+        return "some transcript"
+
+    async def timing_out(*args, **kwargs):
+        raise openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com"))
+
+    async def fake_metadata(client, video_id):
+        return None
+
+    monkeypatch.setattr(main, "get_video_transcript", fake_transcript)
+    monkeypatch.setattr(main, "get_video_title_description", fake_metadata)
+    monkeypatch.setattr(main, "generate_questions_from_text", timing_out)
+
+    with TestClient(main.app) as client:
+        response = client.post("/generate-quiz", json={"playlistUrl": "https://youtu.be/abcdefghijk"})
+
+    assert response.status_code == 502
+
+
+def test_fetch_video_text_skips_metadata_lookup_for_cached_transcript(monkeypatch):
+    metadata_calls = []
+
+    async def fake_metadata(client, video_id):
+        metadata_calls.append(video_id)
+        return ("title", "description")
+
+    monkeypatch.setattr(main, "get_cached_transcript", lambda video_id: "cached transcript")
+    monkeypatch.setattr(main, "get_video_title_description", fake_metadata)
+
+    text = asyncio.run(main.fetch_video_text(None, "abcdefghijk"))
+
+    assert text == "cached transcript"
+    assert metadata_calls == []
+
+
+def test_metrics_require_admin_token(monkeypatch):
+    client = TestClient(main.app)
+
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    assert client.get("/metrics", headers={"X-Admin-Token": "wrong"}).status_code == 403
+
+    response = client.get("/metrics", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert b"ytquiz_question_cache_hits_total" in response.content
+
+
+def test_cache_clear_reports_per_process_scope(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main.quiz_store, "_redis", None)
+
+    response = TestClient(main.app).post("/cache/clear", headers={"X-Admin-Token": "secret"})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": "cleared",
+        "all_workers": [],
+        "this_worker_only": ["transcripts", "video_metadata", "playlists", "questions"],
+    }
+
+
+def test_batch_quiz_round_trip_from_submit_to_scoring(monkeypatch):
+    job = SimpleNamespace(id="batch_rt", status="in_progress", output_file_id=None, metadata=None)
+
+    async def fake_transcript(video_id, languages=("en",)):
+        return f"transcript of {video_id}"
+
+    async def fake_playlist(client, playlist_id, max_videos):
+        return ["aaaaaaaaaaa", "bbbbbbbbbbb"]
+
+    async def fake_file_create(file, purpose):
+        return SimpleNamespace(id="file-in")
+
+    async def fake_batch_create(input_file_id, endpoint, completion_window, metadata):
+        job.metadata = metadata
+        return job
+
+    async def fake_retrieve(batch_id):
+        return job
+
+    async def fake_content(file_id):
+        content = orjson.dumps(
+            {
+                "per_video": [
+                    {"id": label, "questions": [{
+                        "question": f"about {label}",
+                        "options": ["a", "b", "c", "d"],
+                        "correct_index": 2,
+                        "explanation": "",
+                    }]}
+                    for label in ("V1", "V2")
+                ]
+            }
+        ).decode()
+        line = {
+            "custom_id": "group-0",
+            "response": {
+                "status_code": 200,
+                "body": {"choices": [{"message": {"content": content}}]},
+            },
+        }
+        return SimpleNamespace(text=orjson.dumps(line).decode())
+
+    monkeypatch.setattr(main.quiz_store, "_redis", None)
+    monkeypatch.setattr(main, "get_cached_transcript", lambda video_id: None)
+    monkeypatch.setattr(main, "get_video_transcript", fake_transcript)
+    monkeypatch.setattr(main, "get_playlist_video_ids", fake_playlist)
+    monkeypatch.setattr(main.aclient.files, "create", fake_file_create)
+    monkeypatch.setattr(main.aclient.files, "content", fake_content)
+    monkeypatch.setattr(main.aclient.batches, "create", fake_batch_create)
+    monkeypatch.setattr(main.aclient.batches, "retrieve", fake_retrieve)
+
+    with TestClient(main.app) as client:
+        response = client.post(
+            "/generate-quiz",
+            json={"playlistUrl": "https://youtube.com/playlist?list=PLx", "mode": "batch",
+                  "questionsPerVideo": 1},
+        )
+        assert response.status_code == 202
+        assert response.json()["quizId"] == "batch_rt"
+        assert job.metadata["group-0"] == "aaaaaaaaaaa,bbbbbbbbbbb"
+
+        assert client.get("/quiz-status/batch_rt").json()["status"] == "pending"
+
+        job.status, job.output_file_id = "completed", "file-out"
+        status = client.get("/quiz-status/batch_rt").json()
+        assert status["status"] == "completed"
+        assert [q["question"] for q in status["questions"]] == ["about V1", "about V2"]
+
+        scored = client.post(
+            "/submit-quiz",
+            json={"quizId": "batch_rt", "answers": [
+                {"questionId": 0, "selectedIndex": 2},
+                {"questionId": 1, "selectedIndex": 0},
+            ]},
+        ).json()
+        assert (scored["score"], scored["total"]) == (1, 2)
+
+
+def test_fetch_video_text_without_youtube_key_only_looks_up_metadata_as_fallback(monkeypatch):
+    metadata_calls = []
+
+    async def fake_transcript(video_id, languages=("en",)):
+        return "transcript" if video_id == "withcaption" else None
+
+    async def missing_key(client, video_id):
+        metadata_calls.append(video_id)
+        raise RuntimeError("YOUTUBE_API_KEY is not set in .env")
+
+    monkeypatch.setattr(main, "YOUTUBE_API_KEY", None)
+    monkeypatch.setattr(main, "get_cached_transcript", lambda video_id: None)
+    monkeypatch.setattr(main, "get_video_transcript", fake_transcript)
+    monkeypatch.setattr(main, "get_video_title_description", missing_key)
+
+    assert asyncio.run(main.fetch_video_text(None, "withcaption")) == "transcript"
+    assert metadata_calls == []
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.fetch_video_text(None, "nocaptions1"))
+    assert metadata_calls == ["nocaptions1"]
+
@@ -0,0 +1,232 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import quiz_generator  # noqa: E402
+from quiz_generator import _QuestionStreamParser  # noqa: E402
+
+
+def _question(text):
+    return {
+        "question": text,
+        "options": ["a", "b", "c", "d"],
+        "correct_index": 1,
+        "explanation": "because",
+    }
+
+
+def _feed_in_chunks(payload, size):
+    parser = _QuestionStreamParser()
+    completed = []
+    for i in range(0, len(payload), size):
+        completed.extend(parser.feed(payload[i:i + size]))
+    return completed
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 10_000])
+def test_parser_emits_each_question_regardless_of_chunk_boundaries(chunk_size):
+    payload = orjson.dumps(
+        {
+            "per_video": [
+                {"id": "V1", "questions": [_question("q1"), _question("q2")]},
+                {"id": "V2", "questions": [_question("q3")]},
+            ]
+        }
+    ).decode()
+
+    completed = _feed_in_chunks(payload, chunk_size)
+
+    assert completed == [
+        ("V1", _question("q1")),
+        ("V1", _question("q2")),
+        ("V2", _question("q3")),
+    ]
+
+
+def test_parser_ignores_brackets_and_escaped_quotes_inside_strings():
+    tricky = _question('Is "{" a [brace]? \\"} \\\\')
+    payload = orjson.dumps({"per_video": [{"id": "V1", "questions": [tricky]}]}).decode()
+
+    assert _feed_in_chunks(payload, 1) == [("V1", tricky)]
+
+
+def test_parser_falls_back_to_entry_position_when_id_comes_after_questions():
+    payload = orjson.dumps(
+        {
+            "per_video": [
+                {"questions": [_question("q1")], "id": "V1"},
+                {"questions": [_question("q2")], "id": "V2"},
+            ]
+        }
+    ).decode()
+
+    assert _feed_in_chunks(payload, 4) == [
+        ("V1", _question("q1")),
+        ("V2", _question("q2")),
+    ]
+
+
+def _delta_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def test_stream_drains_openai_response_before_consumer_reads(monkeypatch):
+    payload = orjson.dumps(
+        {"per_video": [{"id": "V1", "questions": [_question("q1"), _question("q2")]}]}
+    ).decode()
+    upstream_done = asyncio.Event()
+
+    async def fake_create(**kwargs):
+        async def chunks():
+            for i in range(0, len(payload), 16):
+                yield _delta_chunk(payload[i:i + 16])
+            upstream_done.set()
+        return chunks()
+
+    async def run():
+        monkeypatch.setattr(quiz_generator.aclient.chat.completions, "create", fake_create)
+
+        stream = quiz_generator.stream_questions_from_text(
+            [("vid", "text")], questions_per_video=2, use_cache=False
+        )
+        first = await stream.__anext__()
+        # Let the producer finish while the consumer is "slow"
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        drained = upstream_done.is_set()
+        rest = [q async for q in stream]
+        return first, rest, drained
+
+    first, rest, drained = asyncio.run(run())
+
+    assert first["question"] == "q1"
+    assert [q["question"] for q in rest] == ["q2"]
+    assert drained
+
+
+def test_generated_questions_are_reused_through_quiz_store(monkeypatch):
+    stored = {}
+    calls = []
+
+    async def fake_save(key, questions):
+        stored[key] = questions
+
+    async def fake_load(key):
+        return stored.get(key)
+
+    async def fake_create(**kwargs):
+        calls.append(kwargs)
+        content = orjson.dumps(
+            {"per_video": [{"id": "V1", "questions": [_question("q1"), _question("q2")]}]}
+        ).decode()
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(quiz_generator.quiz_store, "save_questions", fake_save)
+    monkeypatch.setattr(quiz_generator.quiz_store, "load_questions", fake_load)
+    monkeypatch.setattr(
+        quiz_generator._single_attempt_client.chat.completions, "create", fake_create
+    )
+
+    first = asyncio.run(quiz_generator.generate_questions_from_text([("vid1", "text")], 2))
+    second = asyncio.run(quiz_generator.generate_questions_from_text([("vid2", "text")], 2))
+
+    assert len(calls) == 1
+    assert [q["question"] for q in second] == [q["question"] for q in first] == ["q1", "q2"]
+    assert {q["video_id"] for q in second} == {"vid2"}
+
+
+def _batch_output_line(custom_id, status_code, per_video):
+    content = orjson.dumps({"per_video": per_video}).decode()
+    body = {"choices": [{"message": {"content": content}}]}
+    return orjson.dumps(
+        {"custom_id": custom_id, "response": {"status_code": status_code, "body": body}}
+    ).decode()
+
+
+def test_parse_per_video_maps_labels_to_video_ids_in_block_order():
+    content = orjson.dumps(
+        {
+            "per_video": [
+                {"id": "V2", "questions": [_question("b1")]},
+                {"id": "V9", "questions": [_question("stray")]},
+                {"id": "V1", "questions": [_question("a1"), {"question": "malformed"}, _question("a2")]},
+            ]
+        }
+    ).decode()
+
+    per_video = quiz_generator._parse_per_video(content, ["vidA", "vidB", "vidC"], 1)
+
+    assert [[(q["video_id"], q["question"]) for q in qs] for qs in per_video] == [
+        [("vidA", "a1")],
+        [("vidB", "b1")],
+        [],
+    ]
+
+
+def test_batch_round_trip_maps_groups_back_to_videos(monkeypatch):
+    created = {}
+
+    async def fake_file_create(file, purpose):
+        created["lines"] = [orjson.loads(line) for line in file[1].splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    async def fake_batch_create(input_file_id, endpoint, completion_window, metadata):
+        created["metadata"] = metadata
+        return SimpleNamespace(id="batch_1")
+
+    async def fake_retrieve(batch_id):
+        return SimpleNamespace(
+            status="completed", output_file_id="file-out", metadata=created["metadata"]
+        )
+
+    async def fake_content(file_id):
+        # Output lines come back in any order; group-1 failed on OpenAI's side
+        return SimpleNamespace(
+            text="\n".join(
+                [
+                    _batch_output_line("group-1", 500, []),
+                    "",
+                    _batch_output_line(
+                        "group-0",
+                        200,
+                        [
+                            {"id": f"V{i}", "questions": [_question(f"v{i - 1}")]}
+                            for i in range(1, 6)
+                        ],
+                    ),
+                ]
+            )
+        )
+
+    monkeypatch.setattr(quiz_generator.aclient.files, "create", fake_file_create)
+    monkeypatch.setattr(quiz_generator.aclient.files, "content", fake_content)
+    monkeypatch.setattr(quiz_generator.aclient.batches, "create", fake_batch_create)
+    monkeypatch.setattr(quiz_generator.aclient.batches, "retrieve", fake_retrieve)
+
+    videos = [(f"v{i}", f"text {i}") for i in range(7)]
+    batch_id = asyncio.run(quiz_generator.submit_question_batch(videos, questions_per_video=1))
+    questions = asyncio.run(quiz_generator.fetch_question_batch(batch_id))
+
+    assert [line["custom_id"] for line in created["lines"]] == ["group-0", "group-1"]
+    assert created["metadata"] == {
+        "questions_per_video": "1",
+        "group-0": "v0,v1,v2,v3,v4",
+        "group-1": "v5,v6",
+    }
+    assert [(q["video_id"], q["question"]) for q in questions] == [
+        (f"v{i}", f"v{i}") for i in range(5)
+    ]
+
+
+def test_fetch_question_batch_without_output_file_returns_empty(monkeypatch):
+    async def fake_retrieve(batch_id):
+        return SimpleNamespace(status="completed", output_file_id=None, metadata={})
+
+    monkeypatch.setattr(quiz_generator.aclient.batches, "retrieve", fake_retrieve)
+
+    assert asyncio.run(quiz_generator.fetch_question_batch("batch_1")) == []
@@ -0,0 +1,42 @@
+import asyncio
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import quiz_store
+
+
+class _DownRedis:
+    async def set(self, *args, **kwargs):
+        raise RedisConnectionError("down")
+
+    async def get(self, *args, **kwargs):
+        raise RedisConnectionError("down")
+
+    async def exists(self, *args, **kwargs):
+        raise RedisConnectionError("down")
+
+
+def test_quiz_and_batch_fall_back_to_memory_when_redis_is_down(monkeypatch):
+    monkeypatch.setattr(quiz_store, "_redis", _DownRedis())
+    questions = [{"question": "q1", "options": ["a", "b", "c", "d"], "correct_index": 0}]
+
+    async def run():
+        await quiz_store.save_quiz("quiz-down", questions)
+        await quiz_store.save_batch("batch-down")
+        return (
+            await quiz_store.load_quiz("quiz-down"),
+            await quiz_store.is_known_batch("batch-down"),
+            await quiz_store.is_known_batch("batch-other"),
+        )
+
+    assert asyncio.run(run()) == (questions, True, False)
+
+
+def test_quiz_store_uses_memory_without_redis(monkeypatch):
+    monkeypatch.setattr(quiz_store, "_redis", None)
+
+    async def run():
+        await quiz_store.save_quiz("quiz-local", [])
+        return await quiz_store.load_quiz("quiz-local"), await quiz_store.load_quiz("missing")
+
+    assert asyncio.run(run()) == ([], None)
@@ -1,8 +1,10 @@
+import asyncio
 import os
 import re
-import requests
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from youtube_transcript_api import (
     YouTubeTranscriptApi,
@@ -14,63 +16,121 @@ from youtube_transcript_api import (
 load_dotenv()
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
+# URL patterns, compiled once at import
+_PLAYLIST_RE = re.compile(r"[?&]list=([a-zA-Z0-9_-]+)")
+_VIDEO_ID_RE = re.compile(r"[a-zA-Z0-9_-]{11}")
+# v=VIDEOID, youtu.be/VIDEOID or shorts/VIDEOID in a single scan
+_VIDEO_URL_RE = re.compile(r"(?:v=|youtu\.be/|shorts/)([a-zA-Z0-9_-]{11})")
+
+# In-memory TTL caches so repeat requests for the same video/playlist skip
+# the network round-trip and don't spend YouTube API quota twice.
+# Only successful lookups are cached (None may just be a transient error).
+_TRANSCRIPT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=7 * 86400)  # transcripts: 7 days
+_METADATA_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=86400)        # title/description: 24h
+_PLAYLIST_CACHE: TTLCache = TTLCache(maxsize=256, ttl=6 * 3600)      # playlist contents: 6h
+
+
+def clear_caches() -> None:
+    """
+    Drop all cached transcripts, video metadata and playlist listings.
+    """
+    _TRANSCRIPT_CACHE.clear()
+    _METADATA_CACHE.clear()
+    _PLAYLIST_CACHE.clear()
+
 
 def extract_playlist_id(playlist_url: str) -> Optional[str]:
     """
     Extract playlist ID from a YouTube playlist URL.
     Example: https://www.youtube.com/playlist?list=PL123...
     """
-    match = re.search(r"[?&]list=([a-zA-Z0-9_-]+)", playlist_url)
+    match = _PLAYLIST_RE.search(playlist_url)
     return match.group(1) if match else None
 
 
-def get_playlist_video_ids(playlist_id: str, max_videos: int = 5) -> List[str]:
+async def get_playlist_video_ids(
+    client: httpx.AsyncClient,
+    playlist_id: str,
+    max_videos: int = 5,
+) -> List[str]:
     """
     Use YouTube Data API to get up to max_videos video IDs from a playlist.
+
+    Fetches a single page (the API allows up to 50 items per page); callers
+    clamp max_videos well below that. If the cap is ever raised above 50,
+    bring back pagination via nextPageToken.
     """
+    cache_key = (playlist_id, max_videos)
+    cached = _PLAYLIST_CACHE.get(cache_key)
+    if cached is not None:
+        return list(cached)
+
     if not YOUTUBE_API_KEY:
         raise RuntimeError("YOUTUBE_API_KEY is not set in .env")
 
     url = "https://www.googleapis.com/youtube/v3/playlistItems"
-    items_per_page = min(max_videos, 50)
-
     params = {
         "part": "contentDetails",
         "playlistId": playlist_id,
-        "maxResults": items_per_page,
+        "maxResults": min(max_videos, 50),
         "key": YOUTUBE_API_KEY,
     }
 
-    video_ids: List[str] = []
+    resp = await client.get(url, params=params)
+    resp.raise_for_status()
+    data = resp.json()
 
-    while True:
-        resp = requests.get(url, params=params)
-        resp.raise_for_status()
-        data = resp.json()
+    video_ids = [item["contentDetails"]["videoId"] for item in data.get("items", [])][:max_videos]
 
-        for item in data.get("items", []):
-            vid = item["contentDetails"]["videoId"]
-            video_ids.append(vid)
-            if len(video_ids) >= max_videos:
-                return video_ids
+    if video_ids:
+        _PLAYLIST_CACHE[cache_key] = tuple(video_ids)
+    return video_ids
 
-        next_page = data.get("nextPageToken")
-        if not next_page:
-            break
-        params["pageToken"] = next_page
 
-    return video_ids
+def _fetch_transcript_segments(video_id: str, languages: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    """
+    Blocking transcript fetch, meant to run in a worker thread.
+    Supports both the pre-1.0 classmethod API and the 1.x instance API.
+    """
+    if hasattr(YouTubeTranscriptApi, "get_transcript"):
+        return YouTubeTranscriptApi.get_transcript(video_id, languages=list(languages))
+    return YouTubeTranscriptApi().fetch(video_id, languages=languages).to_raw_data()
 
 
-def get_video_transcript(video_id: str, languages: List[str] = ["en"]) -> Optional[str]:
+def get_cached_transcript(
+    video_id: str,
+    languages: Tuple[str, ...] = ("en",),
+) -> Optional[str]:
+    """
+    Return the transcript if it is already cached, without any network call.
+    """
+    return _TRANSCRIPT_CACHE.get((video_id, tuple(languages)))
+
+
+async def get_video_transcript(
+    video_id: str,
+    languages: Tuple[str, ...] = ("en",),
+) -> Optional[str]:
     """
     Fetch transcript text for a video using youtube-transcript-api.
     Returns None if no transcript is available.
+
+    The sync call runs in a worker thread so the event loop stays free while
+    several videos are fetched at once.
     """
+    cached = get_cached_transcript(video_id, languages)
+    if cached is not None:
+        return cached
+
+    cache_key = (video_id, tuple(languages))
+
     try:
-        segments = YouTubeTranscriptApi.get_transcript(video_id, languages=languages)
-        text = " ".join(seg["text"] for seg in segments if seg.get("text"))
-        return text.strip() or None
+        segments = await asyncio.to_thread(_fetch_transcript_segments, video_id, languages)
+        text = " ".join([t for seg in segments if (t := seg.get("text"))]).strip()
+        if not text:
+            return None
+        _TRANSCRIPT_CACHE[cache_key] = text
+        return text
     except (TranscriptsDisabled, NoTranscriptFound, CouldNotRetrieveTranscript):
         return None
     except Exception:
@@ -78,11 +138,18 @@ def get_video_transcript(video_id: str, languages: List[str] = ["en"]) -> Option
         return None
 
 
-def get_video_title_description(video_id: str) -> Optional[Tuple[str, str]]:
+async def get_video_title_description(
+    client: httpx.AsyncClient,
+    video_id: str,
+) -> Optional[Tuple[str, str]]:
     """
     Fallback: use YouTube Data API to get video title and description
     when no transcript is available.
     """
+    cached = _METADATA_CACHE.get(video_id)
+    if cached is not None:
+        return cached
+
     if not YOUTUBE_API_KEY:
         raise RuntimeError("YOUTUBE_API_KEY is not set in .env")
 
@@ -94,7 +161,7 @@ def get_video_title_description(video_id: str) -> Optional[Tuple[str, str]]:
     }
 
     try:
-        resp = requests.get(url, params=params)
+        resp = await client.get(url, params=params)
         resp.raise_for_status()
         data = resp.json()
         items = data.get("items", [])
@@ -109,10 +176,13 @@ def get_video_title_description(video_id: str) -> Optional[Tuple[str, str]]:
         if not title and not description:
             return None
 
+        _METADATA_CACHE[video_id] = (title, description)
         return title, description
     except Exception:
         # In case of API/network issues, just return None
         return None
+
+
 def extract_video_id(url_or_id: str) -> Optional[str]:
     """
     Extract a YouTube video ID from:
@@ -124,22 +194,9 @@ def extract_video_id(url_or_id: str) -> Optional[str]:
     s = url_or_id.strip()
 
     # If it's already a bare 11-char ID
-    if re.fullmatch(r"[a-zA-Z0-9_-]{11}", s):
+    if _VIDEO_ID_RE.fullmatch(s):
         return s
 
-    # Look for v=VIDEOID in query string
-    match = re.search(r"v=([a-zA-Z0-9_-]{11})", s)
-    if match:
-        return match.group(1)
-
-    # youtu.be/VIDEOID
-    match = re.search(r"youtu\.be/([a-zA-Z0-9_-]{11})", s)
-    if match:
-        return match.group(1)
-
-    # /shorts/VIDEOID
-    match = re.search(r"shorts/([a-zA-Z0-9_-]{11})", s)
-    if match:
-        return match.group(1)
-
-    return None
\ No newline at end of file
+    # Look for v=VIDEOID, youtu.be/VIDEOID or /shorts/VIDEOID
+    match = _VIDEO_URL_RE.search(s)
+    return match.group(1) if match else None
\ No newline at end of file